@@ -6,11 +6,15 @@ This script provides functionality to splice together multiple Comlabs Governmen
 
 import os
 import re
+import functools
 import sys
+import wave
 import argparse
-from datetime import datetime, timedelta, timezone
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
 from pydub import AudioSegment
-from pydub.generators import Sine
 
 ALT_MESSAGES = {
     "ADR": "'A daily check message has been issued for' will be used instead of 'An administrative message has been issued for'",
@@ -18,6 +22,84 @@ ALT_MESSAGES = {
     "SVR": "'This is a severe thunderstorm warning for' will be used instead of 'A severe thunderstorm warning has been issued for'",
 }
 
+_ZCZC_RE = re.compile(r"^ZCZC-([A-Z]{3})-([A-Z]{3})-((?:\d{6}(?:-?)){1,31})\+(\d{4})-(\d{7})-([A-Za-z0-9\/ ]{0,8})-?$")
+
+# Basic mapping of most US timezones to their UTC offsets in hours. Source: https://en.wikipedia.org/wiki/Time_in_the_United_States#United_States_and_regional_time_zones
+_TZ_OFFSETS = {
+    "UTC": 0,
+    "AST": -4,
+    "EST": -5,
+    "EDT": -4,
+    "CST": -6,
+    "CDT": -5,
+    "MST": -7,
+    "MDT": -6,
+    "PST": -8,
+    "PDT": -7,
+    "AKST": -9,
+    "AKDT": -8,
+    "HST": -10,
+    "HDT": -9,
+    "SST": -11,
+    "CHST": 10,
+}
+
+# The OS local timezone (as a fixed UTC offset) is resolved once at import instead of on every local-time splice.
+_LOCAL_TZ = datetime.now().astimezone().tzinfo
+
+SplicePlan = namedtuple("SplicePlan", "header_audio body_audio end_audio issue_hour issue_minute duration_hours duration_minutes")
+
+_ONE_SECOND_SILENCE_RAW = bytes(44100 * 2)
+_ONE_SECOND_SILENCE = AudioSegment(data=_ONE_SECOND_SILENCE_RAW, sample_width=2, frame_rate=44100, channels=1)
+
+@functools.lru_cache(maxsize=None)
+def _list_audio_dir(directory):
+    """
+    List the audio files available in one of the EMNet audio directories.
+
+    The directory is scanned once per process with os.scandir, so the per-segment lookups in splice() are set lookups instead of a stat() call for every file. The result maps each lowercased file name to its name on disk, because the archived files mix extension cases (e.g. LOC/001000.WAV next to EVENTS/rwt.wav).
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name.lower(): entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return {}
+
+def _find_audio_file(directory, filename, description):
+    """
+    Resolve an audio file inside one of the EMNet audio directories, raising FileNotFoundError if it is not available.
+    """
+    name = _list_audio_dir(directory).get(filename.lower())
+    if name is None:
+        raise FileNotFoundError(f"{description} audio file {os.path.join(directory, filename)} not found.")
+    return os.path.join(directory, name)
+
+@functools.lru_cache(maxsize=512)
+def _load_wav(path):
+    """
+    Load and decode a WAV file, caching the result by path.
+
+    Alerts routinely reuse the same segments (the 'and'/'until' words, the AM/PM and hour/minute files, common county FIPS codes), so each file is only decoded once per process. AudioSegment objects are immutable, which makes sharing the cached instances safe.
+
+    The archived EMNet files are 11.025 kHz 8-bit mono, so each one is converted here to the 44.1 kHz 16-bit mono format used by the generated tones and silence. Every segment in a splice then shares one format and can be written out as-is.
+    """
+    return AudioSegment.from_wav(path).set_frame_rate(44100).set_sample_width(2).set_channels(1)
+
+@functools.lru_cache(maxsize=None)
+def _attention_signal():
+    """
+    Generate the 8 second EAS attention signal (853 Hz and 960 Hz sine waves played together).
+
+    The signal never changes, so it is synthesized once with NumPy and cached for the lifetime of the process. Both tones are generated at full scale and summed in 32-bit before clipping back to 16-bit, the same result pydub's overlay() produced.
+    """
+    sample_rate = 44100
+    duration_s = 8
+    t = np.arange(sample_rate * duration_s) / sample_rate
+    tone1 = (np.sin(2 * np.pi * 853 * t) * 32767).astype(np.int32)
+    tone2 = (np.sin(2 * np.pi * 960 * t) * 32767).astype(np.int32)
+    pcm = np.clip(tone1 + tone2, -32768, 32767).astype(np.int16).tobytes()
+    return AudioSegment(data=pcm, sample_width=2, frame_rate=sample_rate, channels=1)
+
 def generate_tones(zczc_string):
     """
     Generate EAS tones based on the ZCZC string.
@@ -50,48 +132,52 @@ def generate_tones(zczc_string):
 
     cache = getattr(generate_tones, "_segment_cache", None)
     if cache is None:
-        mark_segment = Sine(mark_freq, sample_rate=sample_rate).to_audio_segment(duration=bit_duration_ms)
-        mark_segment = mark_segment.set_channels(1).set_sample_width(2)
-        space_segment = Sine(space_freq, sample_rate=sample_rate).to_audio_segment(duration=bit_duration_ms)
-        space_segment = space_segment.set_channels(1).set_sample_width(2)
-        gap_segment = AudioSegment.silent(duration=1000, frame_rate=sample_rate).set_channels(1).set_sample_width(2)
-
-        mark_raw = mark_segment.raw_data
-        space_raw = space_segment.raw_data
-        byte_lookup = []
-        for value in range(256):
-            raw_bits = bytearray()
-            for bit_index in range(8):
-                raw_bits.extend(mark_raw if (value >> bit_index) & 1 else space_raw)
-            byte_lookup.append(bytes(raw_bits))
+        samples_per_bit = int(sample_rate * bit_duration_ms / 1000.0)
+        t = np.arange(samples_per_bit) / sample_rate
+        mark_pcm = (np.sin(2 * np.pi * mark_freq * t) * 32767).astype(np.int16)
+        space_pcm = (np.sin(2 * np.pi * space_freq * t) * 32767).astype(np.int16)
+        gap_raw = _ONE_SECOND_SILENCE_RAW
+
+        # Row v of the bit matrix holds the bits of v, least-significant first, so indexing the stacked (space, mark) waveforms with it yields every byte's PCM at once.
+        bit_pcm = np.stack([space_pcm, mark_pcm])
+        bits = (np.arange(256)[:, None] >> np.arange(8)) & 1
+        byte_table = bit_pcm[bits].reshape(256, -1)
 
         cache = {
-            "sample_width": mark_segment.sample_width,
-            "frame_rate": mark_segment.frame_rate,
-            "channels": mark_segment.channels,
-            "byte_lookup": tuple(byte_lookup),
-            "gap_raw": gap_segment.raw_data,
+            "sample_width": 2,
+            "frame_rate": sample_rate,
+            "channels": 1,
+            "byte_table": byte_table,
+            "gap_raw": gap_raw,
         }
         generate_tones._segment_cache = cache
 
     sample_width = cache["sample_width"]
     frame_rate = cache["frame_rate"]
     channels = cache["channels"]
-    byte_lookup = cache["byte_lookup"]
+    byte_table = cache["byte_table"]
     gap_raw = cache["gap_raw"]
 
-    preamble = bytes([0xAB] * 16)
-    burst_bytes = preamble + header_bytes + b"\r"
+    burst_cache = getattr(generate_tones, "_burst_cache", None)
+    if burst_cache is None:
+        burst_cache = {}
+        generate_tones._burst_cache = burst_cache
+
+    # Rendered headers are kept in least-recently-used order (a full-length header is roughly 0.6 MB of PCM), so the cache is capped.
+    raw_audio = burst_cache.pop(header_text, None)
+    if raw_audio is None:
+        preamble = b"\xab" * 16
+        burst_bytes = preamble + header_bytes + b"\r"
+
+        burst_raw = byte_table[np.frombuffer(burst_bytes, dtype=np.uint8)].tobytes()
+        raw_audio = (burst_raw + gap_raw) * 2 + burst_raw
 
-    raw_audio = bytearray()
-    for burst_index in range(3):
-        for value in burst_bytes:
-            raw_audio.extend(byte_lookup[value])
-        if burst_index < 2:
-            raw_audio.extend(gap_raw)
+        if len(burst_cache) >= 32:
+            del burst_cache[next(iter(burst_cache))]
+    burst_cache[header_text] = raw_audio
 
     return AudioSegment(
-        data=bytes(raw_audio),
+        data=raw_audio,
         sample_width=sample_width,
         frame_rate=frame_rate,
         channels=channels,
@@ -110,193 +196,157 @@ def split_zczc(zczc_string):
     JJJHHMM: Date-Time Group (7 digits)
     LLLLLLLL: Station Identifier (up to 8 characters)
 
-    We need to use a regex to split this string into its components. This is because the SAME standard allows for multiple county FIPS codes to be specified in the PSSCCC field, which means that we cannot simply split on the hyphens. The regex below is designed to capture each component of the ZCZC string.
+    We need to use a regex to split this string into its components. This is because the SAME standard allows for multiple county FIPS codes to be specified in the PSSCCC field, which means that we cannot simply split on the hyphens. The module-level _ZCZC_RE regex is designed to capture each component of the ZCZC string.
     """
 
-    pattern = r"^ZCZC-([A-Z]{3})-([A-Z]{3})-((?:\d{6}(?:-?)){1,31})\+(\d{4})-(\d{7})-([A-Za-z0-9\/ ]{0,8})-?$"
-    match = re.match(pattern, zczc_string)
+    match = _ZCZC_RE.match(zczc_string)
 
     if match:
         return match.groups()
     else:
         raise ValueError("Invalid ZCZC string format.")
 
-def splice(output_file, zczc_code, use_local_time=False, include_tones=False, tz_override=None, use_alt_message=False):
+@functools.lru_cache(maxsize=32)
+def plan_splice(zczc_code, include_tones=False, use_alt_event=False):
     """
-    Splice audio segments based on the provided ZCZC code.
-
-    The EMNet audio files are located in the same directory as this script. The audio files are named using the following conventions:
+    Prepare everything in a splice that depends only on the ZCZC code.
 
-    Events:
-    EVENTS/event_code.wav
-    where event_code is the 3-letter event code from the ZCZC header.
-
-    Locations:
-    LOC/location_code.wav
-    where location_code is the 6-digit FIPS code from the ZCZC header.
-
-    Other segments:
-    OTHER/until.wav
-    OTHER/and.wav
-    where 'until' and 'and' are just those words as audio segments used in the splicing process.
-
-    TIMES:
-    TIMES/am.wav
-    TIMES/pm.wav
-    TIMES/hour(01-12).wav
-    TIMES/minute(00-59).wav
-    where these files represent the time components in the ZCZC header. For example, if the duration time is "0130", and the alert was issued at "0011200", we would calculate the end time and use these audio segments accordingly. This would mean in this example that the alert ends at 1:30 PM, so take the hour1.wav, minute30.wav, and pm.wav files.
+    The header is parsed, the event, location and 'until' files are resolved and decoded, and the EAS tones are rendered when requested. Only the end time is left for render_splice(), since it depends on the timezone chosen at render time. Plans are cached, so splicing the same ZCZC code again (for example with a different timezone) goes straight to rendering.
     """
-    audio_segments = []
-
-    if include_tones:
-        audio_segments.append(AudioSegment.silent(duration=1000).set_channels(1).set_sample_width(2))
-        tones = generate_tones(zczc_code)
-        audio_segments.append(tones)
-        audio_segments.append(AudioSegment.silent(duration=1000).set_channels(1).set_sample_width(2))
-        # Append combined attention signal (853+960 Hz) for 8 seconds
-        attention_signal = AudioSegment.silent(duration=0).set_channels(1).set_sample_width(2)
-        freq1 = 853
-        freq2 = 960
-        sample_rate = 44100
-        duration_ms = 8000
-        sine1 = Sine(freq1, sample_rate=sample_rate).to_audio_segment(duration=duration_ms)
-        sine2 = Sine(freq2, sample_rate=sample_rate).to_audio_segment(duration=duration_ms)
-        combined_signal = sine1.overlay(sine2)
-        attention_signal += combined_signal
-        audio_segments.append(attention_signal)
-        audio_segments.append(AudioSegment.silent(duration=1000).set_channels(1).set_sample_width(2))
-
     zczc_split = split_zczc(zczc_code)
     originator, event, location_codes, duration, datetime_group, station_id = zczc_split
     location_code_list = location_codes.split('-')
 
-    if os.path.exists(os.path.join("EVENTS", f"{event}.wav")) and event in ALT_MESSAGES:
-        if use_alt_message or (input(f"Alternative message available for event {event}. This means {ALT_MESSAGES[event]}. Use it? (y/n): ").strip().lower() == 'y' and sys.stdin.isatty()):
-            print(f"Using alternative message for event {event}. This means {ALT_MESSAGES[event]}.")
-            event_file = os.path.join("EVENTS", "ALT", f"{event}.wav")
-        else:
-            event_file = os.path.join("EVENTS", f"{event}.wav")
+    if use_alt_event:
+        event_file = _find_audio_file(os.path.join("EVENTS", "ALT"), f"{event}.wav", "Event")
     else:
-        event_file = os.path.join("EVENTS", f"{event}.wav")
+        event_file = _find_audio_file("EVENTS", f"{event}.wav", "Event")
 
-    if os.path.exists(event_file):
-        audio_segments.append(AudioSegment.from_wav(event_file))
-    else:
-        raise FileNotFoundError(f"Event audio file {event_file} not found.")
+    segment_files = [event_file]
 
     for index, location_code in enumerate(location_code_list):
         if (index == len(location_code_list) - 1) and index != 0:
-            and_file = os.path.join("OTHER", "and.wav")
-            if os.path.exists(and_file):
-                audio_segments.append(AudioSegment.from_wav(and_file))
-            else:
-                raise FileNotFoundError(f"And audio file {and_file} not found.")
-        location_file = os.path.join("LOC", f"{location_code}.wav")
-        if os.path.exists(location_file):
-            audio_segments.append(AudioSegment.from_wav(location_file))
-        else:
-            raise FileNotFoundError(f"Location audio file {location_file} not found.")
-
-    until_file = os.path.join("OTHER", "until.wav")
-
-    if os.path.exists(until_file):
-        audio_segments.append(AudioSegment.from_wav(until_file))
-    else:
-        raise FileNotFoundError(f"Until audio file {until_file} not found.")
+            and_file = _find_audio_file("OTHER", "and.wav", "And")
+            segment_files.append(and_file)
+        location_file = _find_audio_file("LOC", f"{location_code}.wav", "Location")
+        segment_files.append(location_file)
+
+    until_file = _find_audio_file("OTHER", "until.wav", "Until")
+    segment_files.append(until_file)
+
+    # The files are independent, so decode them concurrently (each distinct file only once) and then lay them out in spoken order.
+    unique_files = list(dict.fromkeys(segment_files))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        loaded = dict(zip(unique_files, executor.map(_load_wav, unique_files)))
+
+    header_audio = ()
+    end_audio = ()
+    if include_tones:
+        # Header tones, then the combined attention signal (853+960 Hz) for 8 seconds
+        header_audio = (_ONE_SECOND_SILENCE, generate_tones(zczc_code), _ONE_SECOND_SILENCE, _attention_signal(), _ONE_SECOND_SILENCE)
+        end_audio = (_ONE_SECOND_SILENCE, generate_tones("NNNN"), _ONE_SECOND_SILENCE)
 
     issue_time = datetime_group[3:]
-    issue_hour = int(issue_time[0:2])
-    issue_minute = int(issue_time[2:4])
-    duration_hours = int(duration[0:2])
-    duration_minutes = int(duration[2:4])
+    return SplicePlan(
+        header_audio=header_audio,
+        body_audio=tuple(loaded[path] for path in segment_files),
+        end_audio=end_audio,
+        issue_hour=int(issue_time[0:2]),
+        issue_minute=int(issue_time[2:4]),
+        duration_hours=int(duration[0:2]),
+        duration_minutes=int(duration[2:4]),
+    )
 
-    end_hour = (issue_hour + duration_hours + (issue_minute + duration_minutes) // 60) % 24
-    end_minute = (issue_minute + duration_minutes) % 60
+def render_splice(plan, output_file, use_local_time=False, tz_override=None):
+    """
+    Render a SplicePlan to a WAV file.
+
+    This works out the alert's end time in the requested timezone, appends the matching hour, minute and AM/PM segments after the planned audio, and writes the result to output_file.
+    """
+    offset_minutes = 0
 
     if use_local_time:
         """
         Adjust end time calculation to local timezone. This is done by getting the current timezone from the OS and calculating the offset from UTC. Then, we apply this offset to the issue time and duration to get the correct local end time.
         """
-        tzinfo_sub = datetime.now().astimezone().tzinfo
-        issue_datetime_utc = datetime.now(timezone.utc).replace(hour=issue_hour, minute=issue_minute, second=0, microsecond=0)
-        issue_datetime_local = issue_datetime_utc.astimezone(tzinfo_sub)
-        end_datetime_local = issue_datetime_local + timedelta(hours=duration_hours, minutes=duration_minutes)
-        end_hour = end_datetime_local.hour
-        end_minute = end_datetime_local.minute
+        offset_minutes = int(_LOCAL_TZ.utcoffset(None).total_seconds()) // 60
 
     elif tz_override is not None:
         """
-        Adjust end time calculation to the specified timezone offset. Timezone offsets are specified as the name of the timezone (e.g., "EST", "PDT", etc.). We create a timezone object with the specified offset and apply it to the issue time and duration to get the correct end time. Includes a basic mapping of most US timezones to their UTC offsets. Source: https://en.wikipedia.org/wiki/Time_in_the_United_States#United_States_and_regional_time_zones
+        Adjust end time calculation to the specified timezone offset. Timezone offsets are specified as the name of the timezone (e.g., "EST", "PDT", etc.) and looked up in _TZ_OFFSETS, then applied to the issue time and duration to get the correct end time.
         """
-        tz_offsets = {
-            "UTC": 0,
-            "AST": -4,
-            "EST": -5,
-            "EDT": -4,
-            "CST": -6,
-            "CDT": -5,
-            "MST": -7,
-            "MDT": -6,
-            "PST": -8,
-            "PDT": -7,
-            "AKST": -9,
-            "AKDT": -8,
-            "HST": -10,
-            "HDT": -9,
-            "SST": -11,
-            "CHST": 10,
-        }
-        if tz_override not in tz_offsets:
+        if tz_override not in _TZ_OFFSETS:
             raise ValueError(f"Invalid timezone override: {tz_override}")
-        offset_hours = tz_offsets[tz_override]
-        tzinfo_sub = timezone(timedelta(hours=offset_hours))
-        issue_datetime_utc = datetime.now(timezone.utc).replace(hour=issue_hour, minute=issue_minute, second=0, microsecond=0)
-        issue_datetime_tz = issue_datetime_utc.astimezone(tzinfo_sub)
-        end_datetime_tz = issue_datetime_tz + timedelta(hours=duration_hours, minutes=duration_minutes)
-        end_hour = end_datetime_tz.hour
-        end_minute = end_datetime_tz.minute
+        offset_minutes = _TZ_OFFSETS[tz_override] * 60
+
+    # SAME durations are at most a few hours, so the end time is plain minute arithmetic with a wrap-around at midnight.
+    end_total_minutes = (plan.issue_hour + plan.duration_hours) * 60 + plan.issue_minute + plan.duration_minutes + offset_minutes
+    end_hour = (end_total_minutes // 60) % 24
+    end_minute = end_total_minutes % 60
 
     if end_hour == 0:
-        hour_file = os.path.join("TIMES", "hour12.wav")
-        ampm_file = os.path.join("TIMES", "am.wav")
+        hour_name = "hour12.wav"
+        ampm_name = "am.wav"
     elif end_hour < 12:
-        hour_file = os.path.join("TIMES", f"hour{end_hour:02d}.wav")
-        ampm_file = os.path.join("TIMES", "am.wav")
+        hour_name = f"hour{end_hour:02d}.wav"
+        ampm_name = "am.wav"
     elif end_hour == 12:
-        hour_file = os.path.join("TIMES", "hour12.wav")
-        ampm_file = os.path.join("TIMES", "pm.wav")
+        hour_name = "hour12.wav"
+        ampm_name = "pm.wav"
     else:
-        hour_file = os.path.join("TIMES", f"hour{end_hour - 12:02d}.wav")
-        ampm_file = os.path.join("TIMES", "pm.wav")
+        hour_name = f"hour{end_hour - 12:02d}.wav"
+        ampm_name = "pm.wav"
 
-    minute_file = os.path.join("TIMES", f"minute{end_minute:02d}.wav")
-    if os.path.exists(hour_file):
-        audio_segments.append(AudioSegment.from_wav(hour_file))
-    else:
-        raise FileNotFoundError(f"Hour audio file {hour_file} not found.")
-    if os.path.exists(minute_file):
-        audio_segments.append(AudioSegment.from_wav(minute_file))
-    else:
-        raise FileNotFoundError(f"Minute audio file {minute_file} not found.")
-    if os.path.exists(ampm_file):
-        audio_segments.append(AudioSegment.from_wav(ampm_file))
-    else:
-        raise FileNotFoundError(f"AM/PM audio file {ampm_file} not found.")
+    hour_file = _find_audio_file("TIMES", hour_name, "Hour")
+    minute_file = _find_audio_file("TIMES", f"minute{end_minute:02d}.wav", "Minute")
+    ampm_file = _find_audio_file("TIMES", ampm_name, "AM/PM")
 
-    if include_tones:
-        audio_segments.append(AudioSegment.silent(duration=1000).set_channels(1).set_sample_width(2))
-        tones = generate_tones("NNNN")
-        audio_segments.append(tones)
-        audio_segments.append(AudioSegment.silent(duration=1000).set_channels(1).set_sample_width(2))
-
-    if not audio_segments:
-        raise ValueError("No audio segments found to splice.")
-
-    combined_audio = AudioSegment.silent(duration=0)
-    for segment in audio_segments:
-        combined_audio += segment
-    combined_audio.export(output_file, format="wav")
+    audio_segments = [*plan.header_audio, *plan.body_audio, _load_wav(hour_file), _load_wav(minute_file), _load_wav(ampm_file), *plan.end_audio]
+
+    # Every segment is already 44.1 kHz 16-bit mono (see _load_wav), so stream each segment's raw PCM straight into the output file without building a combined buffer.
+    with wave.open(output_file, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(44100)
+        for segment in audio_segments:
+            wav_file.writeframesraw(segment.raw_data)
+
+def splice(output_file, zczc_code, use_local_time=False, include_tones=False, tz_override=None, use_alt_message=False):
+    """
+    Splice audio segments based on the provided ZCZC code.
+
+    The EMNet audio files are located in the same directory as this script. The audio files are named using the following conventions:
+
+    Events:
+    EVENTS/event_code.wav
+    where event_code is the 3-letter event code from the ZCZC header.
+
+    Locations:
+    LOC/location_code.wav
+    where location_code is the 6-digit FIPS code from the ZCZC header.
+
+    Other segments:
+    OTHER/until.wav
+    OTHER/and.wav
+    where 'until' and 'and' are just those words as audio segments used in the splicing process.
+
+    TIMES:
+    TIMES/am.wav
+    TIMES/pm.wav
+    TIMES/hour(01-12).wav
+    TIMES/minute(00-59).wav
+    where these files represent the time components in the ZCZC header. For example, if the duration time is "0130", and the alert was issued at "0011200", we would calculate the end time and use these audio segments accordingly. This would mean in this example that the alert ends at 1:30 PM, so take the hour1.wav, minute30.wav, and pm.wav files.
+    """
+    event = split_zczc(zczc_code)[1]
+    use_alt_event = False
+
+    if f"{event}.wav".lower() in _list_audio_dir("EVENTS") and event in ALT_MESSAGES:
+        if use_alt_message or (input(f"Alternative message available for event {event}. This means {ALT_MESSAGES[event]}. Use it? (y/n): ").strip().lower() == 'y' and sys.stdin.isatty()):
+            print(f"Using alternative message for event {event}. This means {ALT_MESSAGES[event]}.")
+            use_alt_event = True
+
+    plan = plan_splice(zczc_code, include_tones, use_alt_event)
+    render_splice(plan, output_file, use_local_time, tz_override)
     print(f"Spliced audio saved to {output_file} successfully!")
 
 def main():